@@ -2,18 +2,25 @@ import streamlit as st
 st.set_page_config(page_title="Image Annotation Tool")
 
 import sys
-import json
-import os
-import re
-import pandas as pd
+import shutil
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from io import StringIO
 from datetime import datetime
-import boto3
 from dotenv import load_dotenv
 from botocore.exceptions import ClientError
 from streamlit_image_zoom import image_zoom
+from interface import (
+    append_annotations_to_s3,
+    annotations_s3_key,
+    download_annotations_with_version,
+    extract_key,
+    get_class_name,
+)
+from s3_client import BUCKET_NAME, S3
 try:
     from PIL import Image
 except ImportError:
@@ -24,96 +31,20 @@ sys.path.append("project")
 
 load_dotenv()
 
-# -------------- Load Class Mappings ----------------
-
-def load_class_mappings():
-    """Load class name mappings from JSON file."""
-    try:
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        json_path = os.path.join(script_dir, "class_mappings.json")
-        with open(json_path, "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        st.error("Class mappings JSON file not found.")
-        return {}
-    except Exception as e:
-        st.error(f"Error loading class mappings: {e}")
-        return {}
-
-CLASS_MAPPINGS = load_class_mappings()
-
-def get_class_name(url):
-    """Extract class short form from URL and map to full form."""
-    try:
-        match = re.search(r"/[^/]+/([^_]+)_image_", url)
-        if match:
-            short_form = match.group(1)
-            return CLASS_MAPPINGS.get(short_form, "Unknown")
-        return "Unknown"
-    except Exception as e:
-        st.error(f"Error extracting class name from URL: {e}")
-        return "Unknown"
-
 # -------------- AWS + S3 Config ----------------
-try:
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-        region_name=os.getenv("AWS_REGION"),
-    )
-    BUCKET_NAME = os.getenv("S3_BUCKET")
-except Exception as e:
-    st.error(f"Failed to initialize S3 client: {e}")
-    BUCKET_NAME = None
-
 def test_s3_connection():
     """Test S3 connectivity silently, only display errors."""
     if BUCKET_NAME is None:
         st.error("S3 bucket not configured.")
         return
     try:
-        s3.list_objects_v2(Bucket=BUCKET_NAME, MaxKeys=1)
+        S3.list_objects_v2(Bucket=BUCKET_NAME, MaxKeys=1)
     except ClientError as e:
         error_code = e.response['Error']['Code']
         st.error(f"S3 connection failed: {error_code} - {e.response['Error']['Message']}")
     except Exception as e:
         st.error(f"S3 connection failed: {e}")
 
-def upload_csv_to_s3(local_path, s3_key):
-    if BUCKET_NAME is None:
-        st.error("S3 bucket not configured.")
-        return
-    try:
-        s3.upload_file(local_path, BUCKET_NAME, s3_key)
-        print(f"✅ Uploaded {s3_key} to S3")
-    except ClientError as e:
-        error_code = e.response['Error']['Code']
-        st.error(f"Failed to upload CSV to S3: {error_code} - {e.response['Error']['Message']}")
-    except Exception as e:
-        st.error(f"Failed to upload CSV to S3: {e}")
-
-def download_csv_from_s3(s3_key):
-    """Download CSV from S3 and return as a pandas DataFrame."""
-    if BUCKET_NAME is None:
-        st.error("S3 bucket not configured.")
-        return pd.DataFrame(columns=["Original_Image", "Generated_Image", "Plausibility", "Date"])
-    try:
-        response = s3.get_object(Bucket=BUCKET_NAME, Key=s3_key)
-        csv_content = response['Body'].read().decode('utf-8')
-        df = pd.read_csv(StringIO(csv_content))
-        return df
-    except s3.exceptions.NoSuchKey:
-        return pd.DataFrame(columns=["Original_Image", "Generated_Image", "Plausibility", "Date"])
-    except ClientError as e:
-        error_code = e.response['Error']['Code']
-        st.error(f"Failed to download CSV from S3: {error_code} - {e.response['Error']['Message']}")
-        return pd.DataFrame(columns=["Original_Image", "Generated_Image", "Plausibility", "Date"])
-    except Exception as e:
-        st.error(f"Failed to download CSV from S3: {e}")
-        return pd.DataFrame(columns=["Original_Image", "Generated_Image", "Plausibility", "Date"])
-
-
 
 # ---------------- Session State Setup ----------------
 if "selected_task" not in st.session_state:
@@ -121,8 +52,7 @@ if "selected_task" not in st.session_state:
     app_selector()
     st.stop()
 task = st.session_state.selected_task
-CSV_FILE = f"project/{task}_annotations.csv"
-S3_CSV_KEY = f"annotations/project/{task}_annotations.csv"
+S3_ANNOTATIONS_KEY = annotations_s3_key(task)
 
 if "current_index" not in st.session_state:
     st.session_state.current_index = 0
@@ -130,6 +60,10 @@ if "selections" not in st.session_state:
     st.session_state.selections = {}
 if "completed_sets" not in st.session_state:
     st.session_state.completed_sets = set()
+if "pending_annotations" not in st.session_state:
+    st.session_state.pending_annotations = set()
+if "prefetched_sets" not in st.session_state:
+    st.session_state.prefetched_sets = set()
 
 # ---------------- Load URLs ----------------
 from interface import get_image_sets
@@ -142,32 +76,163 @@ if st.session_state.current_index >= len(image_sets):
     st.session_state.current_index = max(0, len(image_sets) - 1)
 
 # ---------------- Image Fetching ----------------
-@st.cache_data(show_spinner=False)
-def load_image(url):
-    if Image is None:
-        st.error("Cannot load images: Pillow library is missing.")
-        return None
+# Largest side kept in the cache: display width x image_zoom's zoom_factor
+ORIGINAL_MAX_DIM = 1000   # 400px x 2.5
+GENERATED_MAX_DIM = 750   # 300px x 2.5
+
+@st.cache_resource
+def http_session():
+    """Shared HTTP session so image downloads reuse pooled TCP/TLS connections to S3.
+
+    Cached as a resource because this script is re-executed on every rerun.
+    """
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+        ),
+    )
+    return session
+
+# Keyed on the S3 key, so the disk cache is bounded by the dataset size
+@st.cache_data(show_spinner=False, persist="disk", max_entries=2048)
+def load_image_bytes(key, _url, max_dim=None):
+    """Return the encoded image at _url, as a lossless PNG thumbnail if larger than max_dim."""
+    # Stream the body straight into one buffer instead of holding
+    # both the raw response and response.content in memory
+    with http_session().get(
+        _url, stream=True, timeout=15, headers={"Accept-Encoding": "identity"}
+    ) as response:
+        response.raise_for_status()  # raised, so failures are never cached
+        buf = BytesIO()
+        shutil.copyfileobj(response.raw, buf, length=1024 * 1024)
+    buf.seek(0)
+    img = Image.open(buf)
+    if not max_dim or max(img.size) <= max_dim:
+        return buf.getvalue()
+    img = img.convert("RGB")
+    img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+    out = BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+def _fetch_image(url, max_dim=None):
+    """Load and decode one image, returning (image, error message).
+
+    Makes no st.* calls so it can run on worker threads; the caller reports
+    the error.
+    """
     try:
-        response = requests.get(url, timeout=15)
-        response.raise_for_status()
-        img = Image.open(BytesIO(response.content)).convert("RGB")
-        return img
+        data = load_image_bytes(extract_key(url), url, max_dim)
+        return Image.open(BytesIO(data)).convert("RGB"), None
     except requests.exceptions.RequestException as e:
-        st.error(f"Failed to load image {url}: {e}")
-        return None
-    except NameError as e:
-        st.error(f"Image processing error: {e}. Ensure Pillow is installed.")
-        return None
+        return None, f"Failed to load image {url}: {e}"
     except Exception as e:
-        st.error(f"Error processing image {url}: {e}")
-        return None
+        return None, f"Error processing image {url}: {e}"
+
+def load_images_batch(image_set):
+    """Load an image set's original and generated images concurrently.
+
+    Returns [original, *generated], each downscaled for display. Images that
+    fail to load are None and are reported here exactly once.
+    """
+    urls = [image_set["original"], *image_set["generated"]]
+    if Image is None:
+        st.error("Cannot load images: Pillow library is missing.")
+        return [None] * len(urls)
+    max_dims = [ORIGINAL_MAX_DIM] + [GENERATED_MAX_DIM] * len(image_set["generated"])
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        results = list(executor.map(_fetch_image, urls, max_dims))
+    for _, error in results:
+        if error:
+            st.error(error)
+    return [img for img, _ in results]
+
+def _prefetch_worker(image_set):
+    """Download an image set into the load_image_bytes cache, ignoring failures.
+
+    Runs detached from any script run, so it must not call st.* itself; a
+    failed image is simply downloaded (and reported) when it is displayed.
+    """
+    jobs = [(image_set["original"], ORIGINAL_MAX_DIM)]
+    jobs += [(url, GENERATED_MAX_DIM) for url in image_set["generated"]]
+    for url, max_dim in jobs:
+        try:
+            load_image_bytes(extract_key(url), url, max_dim)
+        except Exception:
+            pass
+
+def prefetch_image_set(index):
+    """Warm the load_image_bytes cache for image_sets[index] in a background thread."""
+    if index >= len(image_sets) or index in st.session_state.prefetched_sets:
+        return
+    st.session_state.prefetched_sets.add(index)
+    threading.Thread(target=_prefetch_worker, args=(image_sets[index],), daemon=True).start()
+
+# ---------------- Annotation Saving ----------------
+def annotations_by_key(df):
+    """Index annotation rows by (Original_Image, Generated_Image), last row wins."""
+    return {
+        (row["Original_Image"], row["Generated_Image"]): row
+        for row in df.to_dict("records")
+    }
 
-# ---------------- CSV Saving ----------------
-def save_selection_to_csv(original_url, generated_url, label):
-    def extract_key(url):
-        match = re.search(r"\.com/(.+?)(?:\?|$)", url)
-        return match.group(1) if match else url
+def get_annotations_df():
+    """Return the annotations DataFrame, seeded by get_image_sets and refreshed on navigation.
+
+    Returns None while S3 cannot be read; a failed read is not kept, so the
+    next rerun tries again.
+    """
+    if "annotations_df" not in st.session_state:
+        df, version = download_annotations_with_version(S3_ANNOTATIONS_KEY)
+        if df is None:
+            return None
+        st.session_state.annotations_df = df
+        st.session_state.annotations_version = version
+    return st.session_state.annotations_df
+
+def get_annotations_dict():
+    """Return the session's {(original_key, generated_key): row} annotation map.
+
+    Seeded from S3 once it can be read; selections made before that are kept.
+    """
+    if not st.session_state.get("annotations_seeded"):
+        annotations = st.session_state.get("annotations_dict", {})
+        df = get_annotations_df()
+        if df is not None:
+            annotations = {**annotations_by_key(df), **annotations}
+            st.session_state.annotations_seeded = True
+        st.session_state.annotations_dict = annotations
+    return st.session_state.annotations_dict
+
+def flush_annotations():
+    """Append unsaved selections to the S3 annotations log; returns True once nothing is pending."""
+    pending = st.session_state.pending_annotations
+    if not pending:
+        return True
+    annotations = get_annotations_dict()
+
+    # Keep the edits pending if the upload fails so the next flush retries them
+    rows = [annotations[key] for key in pending]
+    if not append_annotations_to_s3(rows, S3_ANNOTATIONS_KEY):
+        return False
+    pending.clear()
+    return True
+
+def refresh_annotations():
+    """Reload the annotations to pick up rows written by other annotators."""
+    df, version = download_annotations_with_version(S3_ANNOTATIONS_KEY)
+    if df is None:
+        return
+    st.session_state.annotations_df = df
+    st.session_state.annotations_version = version
+    st.session_state.annotations_dict = annotations_by_key(df)
+    st.session_state.annotations_seeded = True
 
+def save_selection(original_url, generated_url, label):
     original = extract_key(original_url)
     generated = extract_key(generated_url)
 
@@ -178,31 +243,26 @@ def save_selection_to_csv(original_url, generated_url, label):
         "Date": datetime.now().strftime("%d-%m-%Y")
     }
 
-    # Ensure project directory exists
-    os.makedirs(os.path.dirname(CSV_FILE), exist_ok=True)
-
-    # Load existing CSV from S3
-    df = download_csv_from_s3(S3_CSV_KEY)
-
-    # Append new data, avoiding duplicates
-    new_row = pd.DataFrame([data])
-    df = pd.concat([df, new_row], ignore_index=True).drop_duplicates(
-        subset=["Original_Image", "Generated_Image"], keep="last"
-    )
-
-    # Save locally and upload to S3
-    df.to_csv(CSV_FILE, index=False)
-    upload_csv_to_s3(CSV_FILE, S3_CSV_KEY)
+    # Each save is one small log shard, so upload it right away; if that
+    # fails the selection stays pending and is retried on the next flush
+    get_annotations_dict()[(original, generated)] = data
+    st.session_state.pending_annotations.add((original, generated))
+    flush_annotations()
 
 # ---------------- Counter for Fully Annotated Originals ----------------
+@st.cache_data(ttl=30, show_spinner=False)
+def count_fully_annotated(s3_key, version, _df):
+    """Count originals with all 5 generated images annotated; cached per annotations version."""
+    counts = _df["Original_Image"].value_counts()
+    return int((counts == 5).sum())
+
 def get_total_fully_annotated():
-    df = download_csv_from_s3(S3_CSV_KEY)
-    if df.empty:
+    df = get_annotations_df()
+    if df is None or df.empty:
         return 0
     try:
-        counts = df.groupby("Original_Image")["Generated_Image"].count()
-        fully_done = counts[counts == 5]
-        return len(fully_done)
+        version = st.session_state.annotations_version
+        return count_fully_annotated(S3_ANNOTATIONS_KEY, version, df)
     except Exception as e:
         st.error(f"Error counting fully annotated images: {e}")
         return 0
@@ -212,12 +272,14 @@ def show_navigation():
     col1, col2, col3 = st.columns([1, 4, 1])
     with col1:
         if st.session_state.current_index == 0:
-            if st.button("Back to Task Selector"):
+            # Never drop unsaved selections: stay here, with the error shown
+            if st.button("Back to Task Selector") and flush_annotations():
                 for key in list(st.session_state.keys()):
                     del st.session_state[key]
                 st.rerun()
         else:
-            if st.button("Previous"):
+            if st.button("Previous") and flush_annotations():
+                refresh_annotations()
                 st.session_state.current_index -= 1
                 if st.session_state.current_index < 0:
                     st.session_state.current_index = 0
@@ -227,14 +289,13 @@ def show_navigation():
         if st.button("Next"):
             index = st.session_state.current_index
             current_set = image_sets[index]
-            def extract_key(url):
-                match = re.search(r"\.com/(.+?)(?:\?|$)", url)
-                return match.group(1) if match else url
             original_key = extract_key(current_set["original"])
-            df = download_csv_from_s3(S3_CSV_KEY)
-            annotations = df[df["Original_Image"] == original_key]
+            annotations = get_annotations_dict()
             generated_keys = [extract_key(url) for url in current_set["generated"]]
-            if len(annotations) == len(generated_keys):
+            if all((original_key, gen_key) in annotations for gen_key in generated_keys):
+                if not flush_annotations():
+                    return
+                refresh_annotations()
                 st.session_state.completed_sets.add(index)
                 if st.session_state.current_index < len(image_sets) - 1:
                     st.session_state.current_index += 1
@@ -243,18 +304,18 @@ def show_navigation():
                 st.warning("⚠ Please annotate all 5 generated images before proceeding.")
 
 # ---------------- Render Generated Image Fragment ----------------
-@st.fragment
-def render_generated_image(index, gen_url, i, original_url, annotations_df):
-    def extract_key(url):
-        match = re.search(r"\.com/(.+?)(?:\?|$)", url)
-        return match.group(1) if match else url
+def select_label(key, original_url, gen_url, label):
+    """Button callback: runs before the fragment reruns, so the ✔ shows immediately."""
+    st.session_state.selections[key] = label
+    save_selection(original_url, gen_url, label)
 
+@st.fragment
+def render_generated_image(index, gen_img, gen_url, i, original_url, annotations):
     fragment_key = f"gen_image_{index}_{i}"
 
     with st.container(key=fragment_key):
         cols = st.columns([2, 3])
         with cols[0]:
-            gen_img = load_image(gen_url)
             if gen_img:
                 gw, gh = gen_img.size
                 gh_scaled = int(gh * 300 / gw)
@@ -267,9 +328,9 @@ def render_generated_image(index, gen_url, i, original_url, annotations_df):
             gen_key = extract_key(gen_url)
             
             if key not in st.session_state.selections:
-                existing_annotation = annotations_df[annotations_df["Generated_Image"] == gen_key]
-                if not existing_annotation.empty:
-                    st.session_state.selections[key] = existing_annotation.iloc[0]["Plausibility"]
+                existing_annotation = annotations.get((extract_key(original_url), gen_key))
+                if existing_annotation is not None:
+                    st.session_state.selections[key] = existing_annotation["Plausibility"]
 
             selected = st.session_state.selections.get(key)
 
@@ -280,31 +341,35 @@ def render_generated_image(index, gen_url, i, original_url, annotations_df):
             with c1:
                 label = "✔ Plausible" if selected == "Plausible" else "Plausible"
                 plausible_key = f"p_{index}_{i}_{gen_key[:10]}"
-                if st.button(label, key=plausible_key):
-                    st.session_state.selections[key] = "Plausible"
-                    save_selection_to_csv(original_url, gen_url, "Plausible")
+                st.button(
+                    label,
+                    key=plausible_key,
+                    on_click=select_label,
+                    args=(key, original_url, gen_url, "Plausible"),
+                )
             with c2:
                 label = "✔ Implausible" if selected == "Implausible" else "Implausible"
                 implausible_key = f"ip_{index}_{i}_{gen_key[:10]}"
-                if st.button(label, key=implausible_key):
-                    st.session_state.selections[key] = "Implausible"
-                    save_selection_to_csv(original_url, gen_url, "Implausible")
+                st.button(
+                    label,
+                    key=implausible_key,
+                    on_click=select_label,
+                    args=(key, original_url, gen_url, "Implausible"),
+                )
 
 # ---------------- Main View ----------------
 def show_main_view():
     index = st.session_state.current_index
     current_set = image_sets[index]
+    annotations = get_annotations_dict()
 
-    def extract_key(url):
-        match = re.search(r"\.com/(.+?)(?:\?|$)", url)
-        return match.group(1) if match else url
-    original_key = extract_key(current_set["original"])
-    df = download_csv_from_s3(S3_CSV_KEY)
+    # Fetch the original and all generated images in parallel and hand the
+    # results to the fragments, so a failed image is not fetched twice
+    original_img, *generated_imgs = load_images_batch(current_set)
 
     st.markdown("### Original Image")
     col1, col2, col3 = st.columns([1, 4, 1])
     with col2:
-        original_img = load_image(current_set["original"])
         if original_img:
             ow, oh = original_img.size
             oh_scaled = int(oh * 400 / ow)
@@ -316,8 +381,11 @@ def show_main_view():
 
     st.markdown("---")
     st.markdown("### Generated Images")
-    for i, gen_url in enumerate(current_set["generated"]):
-        render_generated_image(index, gen_url, i, current_set["original"], df)
+    for i, (gen_url, gen_img) in enumerate(zip(current_set["generated"], generated_imgs)):
+        render_generated_image(index, gen_img, gen_url, i, current_set["original"], annotations)
+
+    # Load the next set while the user annotates this one
+    prefetch_image_set(index + 1)
 
     show_navigation()
 
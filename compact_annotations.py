@@ -0,0 +1,7 @@
+# compact_annotations.py
+from interface import IMAGE_SET_FILES, annotations_s3_key, compact_annotations
+
+# Fold each task's annotation log into a new snapshot; run periodically
+# (e.g. from cron) rather than from the app
+for task in IMAGE_SET_FILES:
+    compact_annotations(annotations_s3_key(task))
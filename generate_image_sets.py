@@ -1,48 +1,54 @@
-import boto3
 import os
 import json
-from dotenv import load_dotenv
-
-load_dotenv()
+from concurrent.futures import ThreadPoolExecutor
+from s3_client import S3
 
 BUCKET = "dpoimages"
-REGION = os.getenv("AWS_REGION")
-s3 = boto3.client(
-    "s3",
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    region_name=REGION
-)
 
 def generate_presigned_url(key):
-    return s3.generate_presigned_url("get_object", Params={"Bucket": BUCKET, "Key": key}, ExpiresIn=3600*24*7)  # 7 days
+    return S3.generate_presigned_url("get_object", Params={"Bucket": BUCKET, "Key": key}, ExpiresIn=3600*24*7)  # 7 days
+
+def list_keys(prefix):
+    """Return every object key under prefix, following list_objects_v2 pagination."""
+    paginator = S3.get_paginator("list_objects_v2")
+    keys = []
+    for page in paginator.paginate(Bucket=BUCKET, Prefix=prefix):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []))
+    return keys
 
 def build_image_sets(orig_prefix, gen_prefix, output_filename):
-    response = s3.list_objects_v2(Bucket=BUCKET, Prefix=orig_prefix)
-    image_sets = []
+    # One paginated listing instead of probing each generated key
+    existing_gen_keys = set(list_keys(gen_prefix))
 
-    for obj in response.get("Contents", []):
-        orig_key = obj["Key"]
+    candidates = []
+    for orig_key in list_keys(orig_prefix):
         if orig_key.endswith("/"): continue
 
         orig_filename = os.path.basename(orig_key)  # e.g., ART_Image_1.jpg
         base = os.path.splitext(orig_filename)[0]   # e.g., ART_Image_1
-        orig_url = generate_presigned_url(orig_key)
-
-        gen_urls = []
+        gen_keys = []
         for i in range(5):
             gen_key = f"{gen_prefix}generated_{base}_{i}.png"  # assuming gen images are .png
-            try:
-                gen_url = generate_presigned_url(gen_key)
-                gen_urls.append(gen_url)
-            except:
+            if gen_key in existing_gen_keys:
+                gen_keys.append(gen_key)
+            else:
                 print(f"⚠ Missing: {gen_key}")
 
-        if len(gen_urls) == 5:
-            image_sets.append({
-                "original": orig_url,
-                "generated": gen_urls
-            })
+        if len(gen_keys) == 5:
+            candidates.append((orig_key, gen_keys))
+
+    # Sign every URL in parallel
+    all_keys = [key for orig_key, gen_keys in candidates for key in (orig_key, *gen_keys)]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        urls = dict(zip(all_keys, executor.map(generate_presigned_url, all_keys)))
+
+    image_sets = [
+        {
+            "original": urls[orig_key],
+            "generated": [urls[gen_key] for gen_key in gen_keys]
+        }
+        for orig_key, gen_keys in candidates
+    ]
 
     # Save JSON
     with open(output_filename, "w") as f:
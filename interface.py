@@ -1,36 +1,294 @@
 # interface.py
 import streamlit as st
+import functools
 import json
 import os
-import boto3
+import threading
+import time
+import uuid
 import pandas as pd
-from io import StringIO
-from dotenv import load_dotenv
-import re
-
-load_dotenv()
-
-# -------------- AWS S3 Config ----------------
-s3 = boto3.client(
-    "s3",
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    region_name=os.getenv("AWS_REGION"),
-)
-BUCKET_NAME = os.getenv("S3_BUCKET")
-
-def download_csv_from_s3(s3_key):
-    """Download CSV from S3 and return as a pandas DataFrame."""
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from botocore.exceptions import ClientError
+from s3_client import BUCKET_NAME, S3
+
+def extract_key(url):
+    """Return the S3 object key for a (presigned) S3 URL."""
+    tail = url.split(".amazonaws.com/", 1)[-1]
+    return tail.split("?", 1)[0]
+
+# -------------- Load Class Mappings ----------------
+@st.cache_resource
+def load_class_mappings():
+    """Load class name mappings from JSON file."""
+    try:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        json_path = os.path.join(script_dir, "class_mappings.json")
+        with open(json_path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        st.error("Class mappings JSON file not found.")
+        return {}
+    except Exception as e:
+        st.error(f"Error loading class mappings: {e}")
+        return {}
+
+@functools.lru_cache(maxsize=8192)
+def get_class_name(url):
+    """Extract class short form from URL and map to full form.
+
+    File names look like <short>_image_<n>.<ext>, e.g. akiec_image_1.jpg.
+    """
+    filename = url.split("?", 1)[0].rsplit("/", 1)[-1]
+    short_form, sep, _ = filename.partition("_image_")
+    if not sep:
+        return "Unknown"
+    return load_class_mappings().get(short_form, "Unknown")
+
+# -------------- Annotation Storage ----------------
+# Annotations live in Parquet snapshots plus an append-only log of small
+# JSONL shards. Saving only writes a new shard. compact_annotations() folds
+# settled shards into a new snapshot named after the last shard it covers,
+# so readers take the newest snapshot and only list the shards after it;
+# no object a reader or writer relies on is ever overwritten.
+ANNOTATION_COLUMNS = ["Original_Image", "Generated_Image", "Plausibility", "Date"]
+
+# Only fold shards older than this, so a slow upload named before the
+# cut-off cannot land behind a snapshot
+SHARD_SETTLE_SECONDS = 300
+
+# Superseded snapshots and folded shards are kept this long for in-flight readers
+GC_GRACE_SECONDS = 3600
+
+def _new_cache_entry():
+    return {
+        "lock": threading.RLock(),
+        "snapshot": None, "etag": None, "base": None, "legacy": False,
+        "shards": {}, "version": None, "df": None,
+    }
+
+@st.cache_resource
+def _annotations_cache():
+    """Process-wide {s3_key: entry} cache of snapshots, parsed shards and merged frames."""
+    return {}
+
+def _cache_entry(s3_key):
+    # Entries are shared by every session; hold entry["lock"] while using them
+    return _annotations_cache().setdefault(s3_key, _new_cache_entry())
+
+def annotations_s3_key(task):
+    """S3 key of a task's unversioned annotations snapshot; the log and snapshots live beside it."""
+    return f"annotations/project/{task}_annotations.parquet"
+
+def _shard_prefix(s3_key):
+    """S3 prefix holding the JSONL log shards for the annotations at s3_key."""
+    return s3_key.rsplit(".", 1)[0] + "_log/"
+
+def _snapshot_prefix(s3_key):
+    """S3 prefix holding the versioned Parquet snapshots for the annotations at s3_key."""
+    return s3_key.rsplit(".", 1)[0] + "_snapshots/"
+
+def _object_name(key):
+    """File name of key without its extension, e.g. <time_ns>-<id> for a log shard."""
+    return key.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+
+def _covered_shard(s3_key, snapshot_key):
+    """Key of the last log shard folded into snapshot_key, or "" if it predates the log."""
+    if not snapshot_key.startswith(_snapshot_prefix(s3_key)):
+        return ""
+    return f"{_shard_prefix(s3_key)}{_object_name(snapshot_key)}.jsonl"
+
+def _list_objects(prefix, start_after=""):
+    """Return [(key, last_modified)] under prefix in key order, optionally after start_after."""
+    paginator = S3.get_paginator("list_objects_v2")
+    params = {"Bucket": BUCKET_NAME, "Prefix": prefix}
+    if start_after:
+        params["StartAfter"] = start_after
+    return [
+        (obj["Key"], obj["LastModified"])
+        for page in paginator.paginate(**params)
+        for obj in page.get("Contents", [])
+    ]
+
+def append_annotations_to_s3(rows, s3_key):
+    """Write rows as a new JSONL shard in the annotations log; returns True on success."""
+    if BUCKET_NAME is None:
+        st.error("S3 bucket not configured.")
+        return False
+    # Nanosecond timestamps keep lexicographic key order chronological
+    shard_key = f"{_shard_prefix(s3_key)}{time.time_ns()}-{uuid.uuid4().hex[:8]}.jsonl"
+    try:
+        S3.put_object(
+            Bucket=BUCKET_NAME,
+            Key=shard_key,
+            Body="".join(json.dumps(row) + "\n" for row in rows).encode("utf-8"),
+            ContentType="application/x-ndjson",
+        )
+        entry = _cache_entry(s3_key)
+        with entry["lock"]:
+            entry["shards"][shard_key] = rows
+            entry["version"] = None
+        print(f"✅ Appended {len(rows)} annotations to {shard_key}")
+        return True
+    except ClientError as e:
+        error_code = e.response['Error']['Code']
+        st.error(f"Failed to upload annotations to S3: {error_code} - {e.response['Error']['Message']}")
+        return False
+    except Exception as e:
+        st.error(f"Failed to upload annotations to S3: {e}")
+        return False
+
+def compact_annotations(s3_key):
+    """Fold settled log shards into a new versioned snapshot, then delete what it supersedes.
+
+    Run offline by compact_annotations.py, never from the app; it reads
+    through a private cache entry. Errors are raised.
+    """
+    entry = _new_cache_entry()
+    _refresh_snapshot(s3_key, entry)
+    covered = _covered_shard(s3_key, entry["snapshot"])
+    cutoff = time.time_ns() - SHARD_SETTLE_SECONDS * 10**9
+    shard_keys = [
+        key for key, _ in _list_objects(_shard_prefix(s3_key), covered)
+        if int(_object_name(key).split("-", 1)[0]) < cutoff
+    ]
+    if shard_keys:
+        df = _merge_annotations(entry["base"], (_read_shard(key) for key in shard_keys))
+        snapshot_key = f"{_snapshot_prefix(s3_key)}{_object_name(shard_keys[-1])}.parquet"
+        buf = BytesIO()
+        df.astype({"Plausibility": "category"}).to_parquet(
+            buf, engine="pyarrow", compression="zstd", index=False
+        )
+        S3.put_object(
+            Bucket=BUCKET_NAME,
+            Key=snapshot_key,
+            Body=buf.getvalue(),
+            ContentType="application/vnd.apache.parquet",
+        )
+        print(f"✅ Folded {len(shard_keys)} shards into {snapshot_key}")
+    _collect_garbage(s3_key)
+
+def _collect_garbage(s3_key):
+    """Delete snapshots and shards superseded by a snapshot older than GC_GRACE_SECONDS."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=GC_GRACE_SECONDS)
+    snapshots = _list_objects(_snapshot_prefix(s3_key))
+    aged = [key for key, modified in snapshots if modified < cutoff]
+    if not aged:
+        return
+    # Readers started within the grace period use aged[-1] or a newer snapshot
+    keep = aged[-1]
+    covered = _covered_shard(s3_key, keep)
+    stale = [key for key, _ in snapshots if key < keep]
+    stale += [key for key, _ in _list_objects(_shard_prefix(s3_key)) if key <= covered]
+    for i in range(0, len(stale), 1000):
+        S3.delete_objects(
+            Bucket=BUCKET_NAME,
+            Delete={"Objects": [{"Key": key} for key in stale[i:i + 1000]], "Quiet": True},
+        )
+    if stale:
+        print(f"✅ Deleted {len(stale)} superseded annotation objects")
+
+def read_legacy_csv(s3_key):
+    """Read the CSV that preceded the Parquet file at s3_key, if one exists.
+
+    Only a missing CSV means "no legacy rows"; any other error is raised so a
+    failed read is never mistaken for an empty history.
+    """
     try:
-        response = s3.get_object(Bucket=BUCKET_NAME, Key=s3_key)
-        csv_content = response['Body'].read().decode('utf-8')
-        df = pd.read_csv(StringIO(csv_content))
-        return df
-    except s3.exceptions.NoSuchKey:
-        return pd.DataFrame(columns=["Original_Image", "Generated_Image", "Plausibility", "Date"])
+        response = S3.get_object(Bucket=BUCKET_NAME, Key=s3_key.rsplit(".", 1)[0] + ".csv")
+    except S3.exceptions.NoSuchKey:
+        return pd.DataFrame(columns=ANNOTATION_COLUMNS)
+    return pd.read_csv(BytesIO(response['Body'].read()))
+
+def _read_shard(key):
+    body = S3.get_object(Bucket=BUCKET_NAME, Key=key)['Body'].read().decode('utf-8')
+    return [json.loads(line) for line in body.splitlines() if line]
+
+def _refresh_snapshot(s3_key, entry):
+    """Point entry at the newest snapshot, re-reading it only if it or its ETag changed."""
+    snapshots = _list_objects(_snapshot_prefix(s3_key))
+    # Before the first compaction the unversioned snapshot at s3_key is the base
+    snapshot_key = snapshots[-1][0] if snapshots else s3_key
+    try:
+        params = {"Bucket": BUCKET_NAME, "Key": snapshot_key}
+        if snapshot_key == entry["snapshot"] and entry["base"] is not None and entry["etag"] is not None:
+            params["IfNoneMatch"] = entry["etag"]
+        response = S3.get_object(**params)
+        base = pd.read_parquet(BytesIO(response['Body'].read()))
+        entry["etag"], entry["base"], entry["legacy"] = response['ETag'], base, False
+    except S3.exceptions.NoSuchKey:
+        if snapshot_key != s3_key:
+            raise
+        # No snapshot yet: fall back to the legacy CSV, which never changes.
+        # It is only cached once read successfully; read_legacy_csv raises
+        # on failure, leaving the entry untouched for the next attempt.
+        if not entry["legacy"]:
+            base = read_legacy_csv(s3_key)
+            entry["etag"], entry["base"], entry["legacy"] = None, base, True
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ("304", "NotModified"):
+            raise
+    entry["snapshot"] = snapshot_key
+
+def _refresh_shards(s3_key, entry):
+    """List the log after the snapshot and fetch only shards not seen before; shards are immutable."""
+    covered = _covered_shard(s3_key, entry["snapshot"])
+    shard_keys = [key for key, _ in _list_objects(_shard_prefix(s3_key), covered)]
+    shards = entry["shards"]
+    for key in shard_keys:
+        if key not in shards:
+            shards[key] = _read_shard(key)
+    # Shards up to the snapshot are folded into it
+    for key in set(shards) - set(shard_keys):
+        del shards[key]
+    return shard_keys
+
+def _merge_annotations(base, shard_rows):
+    """Merge snapshot rows with log rows applied in order; the latest row per image pair wins."""
+    merged = {
+        (row["Original_Image"], row["Generated_Image"]): row
+        for row in base.to_dict("records")
+    }
+    for rows in shard_rows:
+        for row in rows:
+            merged[(row["Original_Image"], row["Generated_Image"])] = row
+    return pd.DataFrame.from_records(list(merged.values()), columns=ANNOTATION_COLUMNS)
+
+def _load_annotations(s3_key, entry):
+    """Refresh entry from S3 and return (DataFrame, version).
+
+    Callers must hold entry["lock"]; errors are raised.
+    """
+    _refresh_snapshot(s3_key, entry)
+    shard_keys = _refresh_shards(s3_key, entry)
+    version = f"{entry['snapshot']}:{entry['etag']}+{len(shard_keys)}:{shard_keys[-1] if shard_keys else ''}"
+    if version != entry["version"] or entry["df"] is None:
+        entry["df"] = _merge_annotations(entry["base"], (entry["shards"][key] for key in shard_keys))
+        entry["version"] = version
+    return entry["df"].copy(), version
+
+def download_annotations_with_version(s3_key):
+    """Return (DataFrame, version) for the annotations at s3_key: snapshot plus log, latest row wins.
+
+    The snapshot is fetched with a conditional GET against its cached ETag and
+    each log shard is downloaded once, so unchanged data is never re-parsed.
+    The version token changes whenever the annotations do and is read together
+    with the data. Returns (None, None) if the annotations could not be read.
+    """
+    if BUCKET_NAME is None:
+        st.error("S3 bucket not configured.")
+        return None, None
+    entry = _cache_entry(s3_key)
+    try:
+        with entry["lock"]:
+            return _load_annotations(s3_key, entry)
+    except ClientError as e:
+        error_code = e.response['Error']['Code']
+        st.error(f"Failed to download annotations from S3: {error_code} - {e.response['Error']['Message']}")
+        return None, None
     except Exception as e:
-        print(f"⚠ Failed to download CSV from S3: {e}")
-        return pd.DataFrame(columns=["Original_Image", "Generated_Image", "Plausibility", "Date"])
+        st.error(f"Failed to download annotations from S3: {e}")
+        return None, None
 
 # ------------------- Task Selector UI -------------------
 def app_selector():
@@ -46,18 +304,20 @@ def app_selector():
             st.session_state.selected_task = "derma"
 
 # ------------------- Load JSON-based Image Sets -------------------
-@st.cache_data
-def load_image_sets_from_json(task):
-    """Load image sets from JSON and filter out fully annotated images."""
-    if task == "bone":
-        json_path = "bone_marrow_image_sets.json"
-        csv_key = "annotations/project/bone_annotations.csv"
-    elif task == "derma":
-        json_path = "derma_image_sets.json"
-        csv_key = "annotations/project/derma_annotations.csv"
-    else:
-        return []
+IMAGE_SET_FILES = {
+    "bone": "bone_marrow_image_sets.json",
+    "derma": "derma_image_sets.json",
+}
+
+# Every save makes a new version, so keep only the latest few lists
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_image_sets_from_json(task, version, _annotations_df):
+    """Load image sets from JSON and filter out fully annotated images.
 
+    Cached per (task, annotations version): the filtered list is only rebuilt
+    when the annotations on S3 have changed.
+    """
+    json_path = IMAGE_SET_FILES[task]
     if not os.path.exists(json_path):
         st.error(f"⚠ JSON file not found: {json_path}")
         return []
@@ -69,25 +329,18 @@ def load_image_sets_from_json(task):
         st.error(f"⚠ Failed to load image sets: {e}")
         return []
 
-    # Download and read the CSV from S3
-    df = download_csv_from_s3(csv_key)
-
-    def extract_key(url):
-        match = re.search(r"\.com/(.+?)(?:\?|$)", url)
-        return match.group(1) if match else url
+    # Annotated generated keys per original, built in a single pass
+    df = _annotations_df
+    annotated = df.groupby("Original_Image")["Generated_Image"].agg(set).to_dict()
 
     # Filter out image sets where all generated images are annotated
     filtered_image_sets = []
     for image_set in image_sets:
         original_key = extract_key(image_set["original"])
-        generated_keys = [extract_key(url) for url in image_set["generated"]]
-
-        # Check annotations for this original image
-        annotations = df[df["Original_Image"] == original_key]
-        annotated_gen_keys = set(annotations["Generated_Image"].values)
+        generated_keys = {extract_key(url) for url in image_set["generated"]}
 
         # If not all generated images are annotated, keep this set
-        if len(annotated_gen_keys.intersection(set(generated_keys))) < len(generated_keys):
+        if not generated_keys.issubset(annotated.get(original_key, ())):
             filtered_image_sets.append(image_set)
 
     if not filtered_image_sets:
@@ -98,6 +351,22 @@ def load_image_sets_from_json(task):
 
 # ------------------- Wrapper Function -------------------
 def get_image_sets():
-    """Get image sets for the selected task."""
-    task = st.session_state.get("selected_task")
-    return load_image_sets_from_json(task)
\ No newline at end of file
+    """Get image sets for the selected task.
+
+    The list is fixed for the rest of the session so that current_index
+    keeps pointing at the same set while annotations are saved.
+    """
+    if "image_sets" not in st.session_state:
+        task = st.session_state.get("selected_task")
+        if task not in IMAGE_SET_FILES:
+            return []
+        # Only changed data is fetched, then the cache lookup is free
+        df, version = download_annotations_with_version(annotations_s3_key(task))
+        if df is None:
+            # Don't cache or keep an unfiltered list; retry on the next rerun
+            return []
+        # Seed the session's annotations so app.py does not fetch them again
+        st.session_state.annotations_df = df
+        st.session_state.annotations_version = version
+        st.session_state.image_sets = load_image_sets_from_json(task, version, df)
+    return st.session_state.image_sets
\ No newline at end of file
@@ -0,0 +1,24 @@
+# s3_client.py
+import os
+import boto3
+from botocore.config import Config
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# -------------- Shared AWS S3 Client ----------------
+# One session and client for the whole app so endpoint resolution and
+# pooled connections are reused across every S3 call
+SESSION = boto3.session.Session(
+    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+    region_name=os.getenv("AWS_REGION"),
+)
+S3 = SESSION.client(
+    "s3",
+    config=Config(
+        max_pool_connections=32,
+        retries={"max_attempts": 3, "mode": "adaptive"},
+    ),
+)
+BUCKET_NAME = os.getenv("S3_BUCKET")